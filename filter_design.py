@@ -36,11 +36,18 @@
 #
 # -- Dmitry Nekrasov <bluebag@yandex.ru>   Sun, 07 Apr 2024 18:29:33 +0300
 
-import matplotlib.pyplot as plt
 import numpy as np
 from   scipy import signal
 
+# numba is optional, it only speeds up testbench reference data preparation
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
 def draw_plot( b=None, sos=None ):
+    # Imported here, testbenches use this module and never plot anything
+    import matplotlib.pyplot as plt
     if b is not None:
         w_fir, h_fir = signal.freqz(     b, worN=8000)
         plt.plot( w_fir * 44100 /(np.pi*2), np.abs(h_fir), color='blue', label='FIR')
@@ -69,6 +76,160 @@ def float_to_twos_complement( x, cw ):
     return np.reshape( y, x.shape )
 
 
+# Rounds filter output x (in data units) to integers the way testbenches expect:
+# round to 1/scale, then truncate towards zero and saturate to [lo, hi]
+if njit is not None:
+    @njit( cache=True )
+    def quantize_clip_cpu( x, scale, lo, hi ):
+        # Saturated values fit data width, int32 is enough
+        y = np.empty( x.shape[0], np.int32 )
+        inv = 1.0 / scale
+        for i in range( x.shape[0] ):
+            # np.rint() rounds half to even, like python's round()
+            v = int( np.rint( x[i] * scale ) * inv )
+            y[i] = min( max( v, lo ), hi )
+        return y
+else:
+    def quantize_clip_cpu( x, scale, lo, hi ):
+        y = np.round( x * scale )
+        y *= 1.0 / scale
+        # Saturate before the cast, so out of range values can't wrap around in
+        # int32. lo/hi are integers, so it doesn't matter for truncation
+        np.clip( y, lo, hi, out=y )
+        return y.astype( np.int32 )
+
+
+# Below this amount of samples copying to GPU and back costs more than it saves
+GPU_MIN_SAMPLES = 1 << 20
+
+# Same as quantize_clip_cpu(), but very long sequences go to GPU if cupy is
+# installed and there is a CUDA device
+def quantize_clip( x, scale, lo, hi ):
+    if( len(x) >= GPU_MIN_SAMPLES ):
+        # Imported here, so only such long runs pay for cupy import
+        try:
+            import cupy
+            gpu = cupy.cuda.runtime.getDeviceCount() > 0
+        except Exception:
+            gpu = False
+        if( gpu ):
+            y = cupy.round( cupy.asarray( x ) * scale )
+            y *= 1.0 / scale
+            cupy.clip( y, lo, hi, out=y )
+            return cupy.asnumpy( y.astype( cupy.int32 ) )
+    return quantize_clip_cpu( x, scale, lo, hi )
+
+
+# First len(x) output samples of linear phase FIR b (b[k] == b[len(b)-1-k]).
+# With numba symmetric taps are folded, so it takes half the multiplications of
+# direct form. Otherwise it is just FFT convolution
+if njit is not None:
+    @njit( cache=True )
+    def linear_phase_fir( b, x ):
+        M    = b.shape[0]
+        half = M // 2
+        # x[n-k] is xp[n+M-1-k], zeros before the first sample
+        xp = np.zeros( x.shape[0] + M - 1 )
+        xp[M-1:] = x
+        y = np.empty( x.shape[0] )
+        for n in range( x.shape[0] ):
+            acc = 0.0
+            for k in range( half ):
+                acc += b[k] * ( xp[n+M-1-k] + xp[n+k] )
+            if( M % 2 ):
+                acc += b[half] * xp[n+half]
+            y[n] = acc
+        return y
+else:
+    def linear_phase_fir( b, x ):
+        return signal.oaconvolve( x.astype( np.float64 ), b )[:len(x)]
+
+
+# Fixed point model of rtl/looped_sos_iir.sv, ob is its OB parameter. sos_int
+# are integer coefficients as the RTL sees them (see looped_sos_iir_model()), x
+# is integer input. Returns integer output as data_o is expected to be
+def looped_sos_iir_loop( sos_int, x, dw, cw, ob ):
+    nsections = sos_int.shape[0]
+    z1 = np.zeros( nsections, np.int64 )
+    z2 = np.zeros( nsections, np.int64 )
+    w_max   =  ( 1 << (dw+ob-1) ) - 1
+    w_min   = -( 1 << (dw+ob-1) )
+    osl_max =  ( 1 << (dw+cw+ob-1) ) - 1
+    osl_min = -( 1 << (dw+cw+ob-1) )
+    out_max =  ( 1 << (dw+cw-2) ) - 1
+    out_min = -( 1 << (dw+cw-2) )
+    y = np.empty( x.shape[0], np.int64 )
+    for n in range( x.shape[0] ):
+        z0 = x[n] << (cw-1)
+        for i in range( nsections ):
+            # feedback path, rounded to data width and saturated
+            feedback_sum = z0 + z1[i] * sos_int[i,4] * 2 + z2[i] * sos_int[i,5]
+            fbs = ( feedback_sum >> (cw-1) ) + ( ( feedback_sum >> (cw-2) ) & 1 )
+            fbs = min( max( fbs, w_min ), w_max )
+            # feedforward path, full precision goes to the next section
+            ffs = fbs * sos_int[i,0] + z1[i] * sos_int[i,1] + z2[i] * sos_int[i,2]
+            z0  = min( max( ffs, osl_min ), osl_max )
+            z2[i] = z1[i]
+            z1[i] = fbs
+        y[n] = min( max( z0, out_min ), out_max ) >> (cw-1)
+    return y
+
+if njit is not None:
+    looped_sos_iir_loop = njit( cache=True )( looped_sos_iir_loop )
+
+
+# Integer coefficients as looped_sos_iir.sv sees them. sos is what
+# gen_sos_iir() returns (a's for DIRECT form)
+def looped_sos_iir_coefficients( sos, cw ):
+    scale   = 1 << (cw-1)
+    sos_int = np.rint( sos * scale ).astype( np.int64 )
+    # a1 goes to verilog header divided by 2 and RTL multiplies it back
+    sos_int[:,4] = np.rint( sos[:,4] * scale / 2 )
+    return sos_int
+
+
+# x is integer input. It models the RTL, it can't tell how accurate the filter
+# is, only if the RTL does what it is expected to do
+def looped_sos_iir_model( sos, x, dw, cw, ob=0 ):
+    sos_int = looped_sos_iir_coefficients( sos, cw )
+    return looped_sos_iir_loop( sos_int, np.asarray( x, dtype=np.int64 ), dw, cw, ob )
+
+
+# Same as signal.sosfilt() for every row of x, each row with its own filter:
+# sos[i,:nsections[i]] are sections of i-th filter (a's for TRANSPOSED form, as
+# scipy expects, a0 = 1). Rows are independent, with numba they run in parallel
+if njit is not None:
+    @njit( cache=True, parallel=True )
+    def sosfilt_batch_loop( sos, nsections, x ):
+        y = np.empty( x.shape )
+        for i in prange( x.shape[0] ):
+            zi = np.zeros( ( nsections[i], 2 ) )
+            for n in range( x.shape[1] ):
+                v = x[i,n]
+                # Direct form II transposed, the same way sosfilt() does it
+                for j in range( nsections[i] ):
+                    out     = sos[i,j,0] * v + zi[j,0]
+                    zi[j,0] = sos[i,j,1] * v - sos[i,j,4] * out + zi[j,1]
+                    zi[j,1] = sos[i,j,2] * v - sos[i,j,5] * out
+                    v       = out
+                y[i,n] = v
+        return y
+else:
+    def sosfilt_batch_loop( sos, nsections, x ):
+        return np.stack( [ signal.sosfilt( sos[i,:nsections[i]], x[i] ) for i in range( x.shape[0] ) ] )
+
+
+# signal.sosfilt( sos_list[i], x[i] ) for all filters at once. All rows of x
+# have equal length
+def sosfilt_batch( sos_list, x ):
+    nsections = np.array( [ len(sos) for sos in sos_list ], dtype=np.int64 )
+    # Filters of lower order are padded with zeros, only nsections[i] are used
+    sos = np.zeros( ( len(sos_list), nsections.max(), 6 ) )
+    for i in range( len(sos_list) ):
+        sos[i,:nsections[i]] = sos_list[i]
+    return sosfilt_batch_loop( sos, nsections, np.asarray( x, dtype=np.float64 ) )
+
+
 def gen_ram_fir( ntaps, cutoff, cw, filter_type, rom_fname=None ):
     N = int(2**(np.ceil(np.log2(ntaps))))
     pass_zero = True if filter_type=="lowpass" else False
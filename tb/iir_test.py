@@ -30,10 +30,11 @@
 #
 # Needs a Linux distro and modelsim. vsim binary must be visible through $PATH
 #
-# This is rather an example, it is expected that it would be automatically
-# paremeterized to automatically run in loop through a set of parameters, or
-# tuned for a individual case if a filter instance is supposed to be configured
-# once per project and never changed later.
+# This is rather an example, it is expected that it would be tuned for a
+# individual case if a filter instance is supposed to be configured once per
+# project and never changed later. In automatic mode it runs every combination
+# of SWEEP_* parameters, each case in its own temporary directory, several vsim
+# instances in parallel. Results are appended to "log".
 #
 # Run:
 #   python3 iir_test.py
@@ -42,13 +43,18 @@
 #
 
 import numpy as np
-from scipy.signal import sosfilt
 import sys
 import os
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 cwd = os.getcwd()
 sys.path.append( cwd + '/../')
-from filter_design import gen_sos_iir
+from filter_design import gen_sos_iir, quantize_clip, looped_sos_iir_model, sosfilt_batch
 
 ############################################################################
 # Test parameters
@@ -61,9 +67,23 @@ CUTOFF                   = FSAMPLE//8
 FILTER_TYPE              = ( "lowpass", "highpass" )[0]
 IIR_VERILOG_HEADER_FNAME = 'sos_iir_coefficients.v'
 ARCHITECTURE             = "LOOPED SOS"
-CLK_PER_SAMPLE           = NTAPS//2 + 10
 SHOW_PSD                 = False
 TESTBENCH_MODE           = ( "manual", "automatic" )[1]
+SEED                     = 0xDEADBEEF # test data is the same from run to run
+# "float" is floating point filter output, tb.sv scores RTL accuracy against it.
+# "rtl model" is a fixed point model of looped_sos_iir.sv, RTL must match it
+# with zero error. It checks the RTL, not the filter quality
+REFERENCE                = ( "float", "rtl model" )[0]
+OB                       = 0 # "rtl model" only, must be equal to OB in looped_sos_iir.sv
+
+# Automatic mode only. Every combination of these is tested. Manual mode takes
+# single case from the parameters above
+SWEEP_NTAPS              = [ NTAPS ]
+SWEEP_CUTOFF             = [ CUTOFF ]
+SWEEP_FILTER_TYPE        = [ FILTER_TYPE ]
+SWEEP_DW_CW              = [ ( DATA_WIDTH, COEFFICIENT_WIDTH ) ]
+# How many vsim instances run at the same time
+JOBS                     = multiprocessing.cpu_count()
 
 RTL_FILES = [
   "../rtl/sat.sv",
@@ -72,116 +92,212 @@ RTL_FILES = [
   "../rtl/iir.sv"
 ]
 
-############################################################################
-# Get filter coefficients
+TB_DIR   = cwd
+TB_FILES = [ "tb.sv", "make.tcl" ]
 
-sos = gen_sos_iir( ntaps                = NTAPS,
-                   cutoff               = CUTOFF,
-                   cw                   = COEFFICIENT_WIDTH,
-                   filter_type          = FILTER_TYPE,
-                   verilog_header_fname = IIR_VERILOG_HEADER_FNAME
-)
+N = 100 # test data length
 
-############################################################################
-# Translate config to verilog
-
-f = open( "testbench_parameters.v", "w" )
-f.write(f"`define IIR\n")
-f.write(f"parameter DATA_WIDTH        = {DATA_WIDTH};\n")
-f.write(f"parameter COEFFICIENT_WIDTH = {COEFFICIENT_WIDTH};\n")
-f.write(f'parameter TYPE              = "{FILTER_TYPE}";\n')
-f.write(f"parameter ORDER             = {NTAPS};\n")
-f.write(f'parameter ARCHITECTURE      = "{ARCHITECTURE}";\n')
-f.write(f'parameter CLK_PER_SAMPLE    = {CLK_PER_SAMPLE};\n')
-f.write(f'parameter TEST_DATA_FNAME   = "input.txt";\n')
-f.write(f'parameter REF_DATA_FNAME    = "ref.txt";\n')
-f.write(f'parameter TESTBENCH_MODE    = "{TESTBENCH_MODE}";\n')
-f.close()
-
-f = open( "files", "w" )
-for i in range(len(RTL_FILES)):
-    f.write(f"{RTL_FILES[i]}\n")
-f.close()
 
-############################################################################
-# Prepare test data
-
-N =  100
-dw = DATA_WIDTH
-cw = COEFFICIENT_WIDTH
-
-max_val =  2**(dw-1)-1
-min_val = -2**(dw-1)
-
-# because gen_sos_iir() returns a's for DIRECT FORM, not TRANSPOSED.
-# And scipy sosfilt expect a's for TRANSPOSED form. They are inverted there.
-sos[:,4] = -sos[:,4]
-sos[:,5] = -sos[:,5]
-
-test_data = np.random.randint( min_val//4, max_val//4, N )
-ref_data  = sosfilt( sos, test_data )
-
-ref_data_floored = np.zeros_like( ref_data, dtype=int )
-for i in range(len(ref_data)):
-    ref_data_floored[i] = int( round( ref_data[i] * 2**(cw-1) ) / 2**(cw-1) )
-    if( ref_data_floored[i] > max_val ):
-        ref_data_floored[i] = max_val
-    if( ref_data_floored[i] < min_val ):
-        ref_data_floored[i] = min_val
-
-
-if( SHOW_PSD ):
-    import matplotlib.pyplot as plt
-    fig, (ax0, ax1 ) = plt.subplots(2,1, layout='constrained')
-    ax0.psd( test_data )
-    ax1.psd( ref_data_floored )
-    plt.show()
-    exit()
-
-
-td = open( "input.txt", "w" )
-rd = open( "ref.txt",   "w" )
-for i in range(N):
-    td.write("%d\n" % test_data[i])
-    rd.write("%d\n" % ref_data_floored[i])
-td.close()
-rd.close()
-
-
-if( TESTBENCH_MODE == "automatic" ):
-    run_vsim = "vsim -c -do make.tcl"
-    vsim = subprocess.Popen( run_vsim.split(), stdout=subprocess.PIPE )
-    res = vsim.communicate()
-    print(res)
-    try:
-        f = open( "score.txt", "r" )
-        score = f.readlines()[0][1:-2]
+# Removes automatic mode case directory, unless it is kept to look into a failed
+# simulation. Manual mode files are kept in tb/
+def clean( workdir, keep=False ):
+    os.chdir( TB_DIR )
+    if( workdir != TB_DIR and not keep ):
+        shutil.rmtree( workdir, ignore_errors=True )
+
+
+def log_header( params ):
+    ntaps, cutoff, filter_type, ( dw, cw ) = params
+    return ( "---------------------------- iir test -------------------------\n"
+             f"Paramters: DW/CW {dw}/{cw} {filter_type} "
+             f"ntaps: {ntaps} Fsample : {FSAMPLE} cutoff: {cutoff}\n" )
+
+
+# Sweep cases which differ only in data width share the same filter, so design
+# it once. Coefficients are cached as tuples (ndarray is mutable) along with the
+# verilog header text gen_sos_iir() generates
+@lru_cache( maxsize=None )
+def design_iir( ntaps, cutoff, cw, filter_type ):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        header_fname = os.path.join( tmpdir, IIR_VERILOG_HEADER_FNAME )
+        sos = gen_sos_iir( ntaps                = ntaps,
+                           cutoff               = cutoff,
+                           cw                   = cw,
+                           filter_type          = filter_type,
+                           verilog_header_fname = header_fname
+        )
+        f = open( header_fname, "r" )
+        header = f.read()
         f.close()
-    except FileNotFoundError:
-        score = "No score.txt were generated by make.tcl routine"
-    f = open( "log", "a" )
-    f.write("---------------------------- iir test -------------------------\n")
-    f.write( f"Paramters: DW/CW {DATA_WIDTH}/{COEFFICIENT_WIDTH} {FILTER_TYPE} ")
-    f.write( f"ntaps: {NTAPS} Fsample : {FSAMPLE} cutoff: {CUTOFF}\n")
-    f.write( f"Results: {score}\n")
-    f.close()
-    # clean
+    return tuple( map( tuple, sos ) ), header
+
+
+# Simulates one case, everything except the simulation itself is already
+# prepared by prepare_cases()
+def run_case( case ):
+    params, header, test_data, ref_data_floored = case
+    ntaps, cutoff, filter_type, ( dw, cw ) = params
+    clk_per_sample = ntaps//2 + 10
+
+    # Each automatic case gets its own directory, so parallel runs don't
+    # overwrite each other's files
+    if( TESTBENCH_MODE == "automatic" ):
+        workdir = tempfile.mkdtemp( prefix="iir_test_" )
+    else:
+        workdir = TB_DIR
+
+    # Case directory must go away whatever happens inside
+    keep = False
     try:
-        os.remove(IIR_VERILOG_HEADER_FNAME)
-        os.remove("testbench_parameters.v")
-        os.remove("files")
-        os.remove("input.txt")
-        os.remove("ref.txt")
-        os.remove("score.txt")
-        os.remove("transcript")
-        os.remove("vsim.wlf")
-        import shutil
-        shutil.rmtree( "work", ignore_errors=True )
-    except FileNotFoundError:
-        pass
+        if( workdir != TB_DIR ):
+            for fname in TB_FILES:
+                shutil.copy( os.path.join( TB_DIR, fname ), workdir )
+        os.chdir( workdir )
+
+        ########################################################################
+        # Translate config to verilog
+
+        f = open( IIR_VERILOG_HEADER_FNAME, "w" )
+        f.write( header )
+        f.close()
 
+        f = open( "testbench_parameters.v", "w" )
+        f.write(f"""`define IIR
+parameter DATA_WIDTH        = {dw};
+parameter COEFFICIENT_WIDTH = {cw};
+parameter TYPE              = "{filter_type}";
+parameter ORDER             = {ntaps};
+parameter ARCHITECTURE      = "{ARCHITECTURE}";
+parameter CLK_PER_SAMPLE    = {clk_per_sample};
+parameter TEST_DATA_FNAME   = "input.txt";
+parameter REF_DATA_FNAME    = "ref.txt";
+parameter TESTBENCH_MODE    = "{TESTBENCH_MODE}";
+""")
+        f.close()
+
+        f = open( "files", "w" )
+        f.write( "".join( f"{os.path.normpath( os.path.join( TB_DIR, fname ) )}\n" for fname in RTL_FILES ) )
+        f.close()
+
+        np.savetxt( "input.txt", test_data,        fmt="%d" )
+        np.savetxt( "ref.txt",   ref_data_floored, fmt="%d" )
+
+
+        if( TESTBENCH_MODE == "automatic" ):
+            run_vsim = "vsim -c -do make.tcl"
+            # Console output goes to a file, no need to hold it in memory. It is
+            # the only diagnostics if compilation or simulation fails
+            f = open( "vsim.log", "w" )
+            subprocess.run( run_vsim.split(), stdout=f, stderr=subprocess.STDOUT )
+            f.close()
+            try:
+                f = open( "score.txt", "r" )
+                score = f.readlines()[0][1:-2]
+                f.close()
+            except FileNotFoundError:
+                keep  = True
+                score = f"No score.txt were generated by make.tcl routine, see vsim.log in {workdir}"
+            return log_header( params ) + f"Results: {score}\n"
+    finally:
+        clean( workdir, keep )
+
+
+# Designs filters and generates test and reference data for all cases. Reference
+# data is floating point filter output or RTL model output, see REFERENCE.
+# Returns cases ready for run_case() and log entries for cases gen_sos_iir()
+# rejected, keyed by their index in params_list
+def prepare_cases( params_list ):
+    designed, rejected = [], {}
+    for i, params in enumerate( params_list ):
+        ntaps, cutoff, filter_type, ( dw, cw ) = params
+        # gen_sos_iir() exits if the filter can't be made with these parameters.
+        # Don't let one bad case stop the whole sweep
+        try:
+            designed.append( ( params, *design_iir( ntaps, cutoff, cw, filter_type ) ) )
+        except SystemExit:
+            rejected[i] = log_header( params ) + "Results: gen_sos_iir() rejected these parameters\n"
+    if( len( designed ) == 0 ):
+        return [], rejected
 
+    ########################################################################
+    # Prepare test data
 
+    dw = np.array( [ params[3][0] for params, sos, header in designed ] )
+    cw = np.array( [ params[3][1] for params, sos, header in designed ] )
 
+    max_val =  2**(dw-1)-1
+    min_val = -2**(dw-1)
 
+    # Test data depends only on SEED and data width, so a case gets the same
+    # data whatever else is in the sweep and in which order
+    test_data = np.stack( [ np.random.default_rng( ( SEED, int( w ) ) ).integers( lo//4, hi//4, N, dtype=np.int32 )
+                            for w, lo, hi in zip( dw, min_val, max_val ) ] )
 
+    if( REFERENCE == "rtl model" ):
+        ref_data_floored = np.stack( [ looped_sos_iir_model( np.array( sos ), test_data[i], dw[i], cw[i], OB )
+                                       for i, ( params, sos, header ) in enumerate( designed ) ] )
+    else:
+        # because gen_sos_iir() returns a's for DIRECT FORM, not TRANSPOSED.
+        # And scipy sosfilt expect a's for TRANSPOSED form. They are inverted there.
+        sos_list = [ np.array( sos ) * [ 1, 1, 1, 1, -1, -1 ] for params, sos, header in designed ]
+        # All cases are filtered in one call, in parallel with numba. Stays in
+        # float64: single precision error accumulates through feedback and flips
+        # LSBs of the reference, which would be counted as RTL error
+        ref_data = sosfilt_batch( sos_list, test_data )
+        # Fixed point scale of the coefficients (all bits but sign are fractional)
+        scale = 1 << (cw-1)
+        ref_data_floored = np.stack( [ quantize_clip( ref_data[i], scale[i], min_val[i], max_val[i] )
+                                       for i in range( len( designed ) ) ] )
+
+    cases = [ ( params, header, test_data[i], ref_data_floored[i] )
+              for i, ( params, sos, header ) in enumerate( designed ) ]
+    return cases, rejected
+
+
+if __name__ == '__main__':
+    if( REFERENCE == "rtl model" and ARCHITECTURE != "LOOPED SOS" ):
+        print( f'"rtl model" reference models only "LOOPED SOS" architecture, not "{ARCHITECTURE}"' )
+        exit()
+
+    if( TESTBENCH_MODE == "automatic" ):
+        params_list = list( itertools.product( SWEEP_NTAPS, SWEEP_CUTOFF, SWEEP_FILTER_TYPE, SWEEP_DW_CW ) )
+    else:
+        params_list = [ ( NTAPS, CUTOFF, FILTER_TYPE, ( DATA_WIDTH, COEFFICIENT_WIDTH ) ) ]
+
+    cases, rejected = prepare_cases( params_list )
+
+    if( SHOW_PSD ):
+        import matplotlib.pyplot as plt
+        for params, header, test_data, ref_data_floored in cases:
+            fig, (ax0, ax1 ) = plt.subplots(2,1, layout='constrained')
+            ax0.psd( test_data )
+            ax1.psd( ref_data_floored )
+            plt.show()
+        exit()
+
+    if( TESTBENCH_MODE == "automatic" ):
+        # Parent has already run threaded numba code (references are computed
+        # with prange), forking it may hang with TBB threading layer. Workers are
+        # forked from a clean forkserver process instead
+        mp_context = multiprocessing.get_context( "forkserver" )
+        with ProcessPoolExecutor( max_workers=JOBS, mp_context=mp_context ) as pool:
+            futures = [ pool.submit( run_case, case ) for case in cases ]
+            finished = []
+            # One failed case must not cost results of all the others
+            for case, future in zip( cases, futures ):
+                try:
+                    finished.append( future.result() )
+                except Exception as e:
+                    # str() of OSError names the file (e.g. missing vsim), repr() doesn't
+                    finished.append( log_header( case[0] ) + f"Results: run_case() failed: {type(e).__name__}: {e}\n" )
+        # Log follows sweep order, rejected cases included
+        finished = iter( finished )
+        results  = [ rejected[i] if i in rejected else next( finished ) for i in range( len( params_list ) ) ]
+        f = open( "log", "a" )
+        f.write( "".join( results ) )
+        f.close()
+    else:
+        for result in rejected.values():
+            print( result )
+        for case in cases:
+            run_case( case )
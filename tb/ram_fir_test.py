@@ -43,13 +43,14 @@
 
 import numpy as np
 import scipy.signal as signal
-#from scipy.signal import sosfilt
 import sys
 import os
+import shutil
 import subprocess
+from pathlib import Path
 cwd = os.getcwd()
 sys.path.append( cwd + '/../')
-from filter_design import gen_ram_fir
+from filter_design import gen_ram_fir, quantize_clip, linear_phase_fir
 
 ############################################################################
 # Test parameters
@@ -64,6 +65,7 @@ RAM_FIR_INIT_FILE_NAME   = "test.mem"
 CLK_PER_SAMPLE           = NTAPS + 10
 SHOW_PSD                 = False
 TESTBENCH_MODE           = ( "manual", "automatic" )[1]
+SEED                     = 0xDEADBEEF # test data is the same from run to run
 
 RTL_FILES = [
   "../rtl/ram.sv",
@@ -74,33 +76,14 @@ RTL_FILES = [
 ############################################################################
 # Get filter coefficients
 
+# ROM init file is needed only for simulation, PSD-only run doesn't write it
 b = gen_ram_fir( ntaps            = NTAPS,
                  cutoff           = CUTOFF,
                  cw               = COEFFICIENT_WIDTH,
                  filter_type      = FILTER_TYPE,
-                 rom_fname        = RAM_FIR_INIT_FILE_NAME
+                 rom_fname        = None if SHOW_PSD else RAM_FIR_INIT_FILE_NAME
                  )
 
-############################################################################
-# Translate config to verilog
-
-f = open( "testbench_parameters.v", "w" )
-f.write(f"`define RAM_FIR\n")
-f.write(f"parameter DATA_WIDTH             = {DATA_WIDTH};\n")
-f.write(f"parameter COEFFICIENT_WIDTH      = {COEFFICIENT_WIDTH};\n")
-f.write(f"parameter ORDER                  = {NTAPS};\n")
-f.write(f'parameter RAM_FIR_INIT_FILE_NAME = "{RAM_FIR_INIT_FILE_NAME}";\n')
-f.write(f'parameter CLK_PER_SAMPLE         = {CLK_PER_SAMPLE};\n')
-f.write(f'parameter TEST_DATA_FNAME        = "input.txt";\n')
-f.write(f'parameter REF_DATA_FNAME         = "ref.txt";\n')
-f.write(f'parameter TESTBENCH_MODE         = "{TESTBENCH_MODE}";\n')
-f.close()
-
-f = open( "files", "w" )
-for i in range(len(RTL_FILES)):
-    f.write(f"{RTL_FILES[i]}\n")
-f.close()
-
 ############################################################################
 # Prepare test data
 
@@ -111,22 +94,25 @@ cw = COEFFICIENT_WIDTH
 max_val =  2**(dw-1)-1
 min_val = -2**(dw-1)
 
-test_data = np.random.randint( min_val//4, max_val//4, N )
+# Fixed point scale of the coefficients (all bits but sign are fractional)
+scale = 1 << (cw-1)
 
-#ref_data = signal.convolve( test_data, b )[:len(test_data)]
-ref_data = signal.lfilter( b, [1.0], test_data )
+rng       = np.random.default_rng( SEED )
+test_data = rng.integers( min_val//4, max_val//4, N, dtype=np.int32 )
 
 # because in ram_fir.sv design input data has one additional delay for
-# bufferization
-ref_data = np.append( 0., ref_data[:-1] )
+# bufferization, filter output is written one sample later
+ref_data    = np.empty( N )
+ref_data[0] = 0.
+# Same as signal.lfilter( b, [1.0], test_data ), but much cheaper than direct
+# form with hundreds of taps. firwin() output is symmetric, but check it anyway,
+# quantization could break it in theory
+if( np.array_equal( b, b[::-1] ) ):
+    ref_data[1:] = linear_phase_fir( b, test_data[:N-1] )
+else:
+    ref_data[1:] = signal.oaconvolve( test_data.astype( np.float64 ), b )[:N-1]
 
-ref_data_floored = np.zeros_like( ref_data, dtype=int )
-for i in range(len(ref_data)):
-    ref_data_floored[i] = int( round( ref_data[i] * 2**(cw-1) ) / 2**(cw-1) )
-    if( ref_data_floored[i] > max_val ):
-        ref_data_floored[i] = max_val
-    if( ref_data_floored[i] < min_val ):
-        ref_data_floored[i] = min_val
+ref_data_floored = quantize_clip( ref_data, scale, min_val, max_val )
 
 
 if( SHOW_PSD ):
@@ -138,46 +124,58 @@ if( SHOW_PSD ):
     exit()
 
 
-td = open( "input.txt", "w" )
-rd = open( "ref.txt",   "w" )
-for i in range(N):
-    td.write("%d\n" % test_data[i])
-    rd.write("%d\n" % ref_data_floored[i])
-td.close()
-rd.close()
+############################################################################
+# Translate config to verilog. Nothing here is needed if we only look at
+# the PSD, so it is done after that
+
+f = open( "testbench_parameters.v", "w" )
+f.write(f"""`define RAM_FIR
+parameter DATA_WIDTH             = {DATA_WIDTH};
+parameter COEFFICIENT_WIDTH      = {COEFFICIENT_WIDTH};
+parameter ORDER                  = {NTAPS};
+parameter RAM_FIR_INIT_FILE_NAME = "{RAM_FIR_INIT_FILE_NAME}";
+parameter CLK_PER_SAMPLE         = {CLK_PER_SAMPLE};
+parameter TEST_DATA_FNAME        = "input.txt";
+parameter REF_DATA_FNAME         = "ref.txt";
+parameter TESTBENCH_MODE         = "{TESTBENCH_MODE}";
+""")
+f.close()
+
+f = open( "files", "w" )
+f.write( "".join( f"{fname}\n" for fname in RTL_FILES ) )
+f.close()
+
+np.savetxt( "input.txt", test_data,        fmt="%d" )
+np.savetxt( "ref.txt",   ref_data_floored, fmt="%d" )
 
 
 if( TESTBENCH_MODE == "automatic" ):
     run_vsim = "vsim -c -do make.tcl"
-    vsim = subprocess.Popen( run_vsim.split(), stdout=subprocess.PIPE )
-    res = vsim.communicate()
-    print(res)
+    # Console output goes to a file, no need to hold it in memory. It is the
+    # only diagnostics if compilation or simulation fails
+    f = open( "vsim.log", "w" )
+    subprocess.run( run_vsim.split(), stdout=f, stderr=subprocess.STDOUT )
+    f.close()
     try:
         f = open( "score.txt", "r" )
         score = f.readlines()[0][1:-2]
         f.close()
+        passed = True
     except FileNotFoundError:
-        score = "No score.txt were generated by make.tcl routine"
+        score  = "No score.txt were generated by make.tcl routine, see vsim.log"
+        passed = False
     f = open( "log", "a" )
     f.write("-------------------------- ram fir test ----------------------------\n")
     f.write( f"Paramters: DW/CW {DATA_WIDTH}/{COEFFICIENT_WIDTH} {FILTER_TYPE} ")
     f.write( f"ntaps: {NTAPS} Fsample : {FSAMPLE} cutoff: {CUTOFF}\n")
     f.write( f"Results: {score}\n")
     f.close()
-    # clean
-    try:
-        os.remove("files")
-        os.remove("test.mem")
-        os.remove("testbench_parameters.v")
-        os.remove("input.txt")
-        os.remove("ref.txt")
-        os.remove("score.txt")
-        os.remove("transcript")
-        os.remove("vsim.wlf")
-        import shutil
+    # clean. If simulation failed everything is kept to see what went wrong
+    if( passed ):
+        for fname in ( "files", RAM_FIR_INIT_FILE_NAME, "testbench_parameters.v", "input.txt",
+                       "ref.txt", "score.txt", "transcript", "vsim.wlf", "vsim.log" ):
+            Path( fname ).unlink( missing_ok=True )
         shutil.rmtree( "work", ignore_errors=True )
-    except FileNotFoundError:
-        pass
 
 
 